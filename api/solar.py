@@ -1,63 +1,178 @@
 from http.server import BaseHTTPRequestHandler
 import requests
+import orjson
+import hashlib
 import os
-import json
+import re
+import socket
+import threading
+import time
 from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+EG4_LOGIN_URL = "https://monitor.eg4electronics.com/WManage/web/login"
+EG4_BASE_URL = "https://monitor.eg4electronics.com/WManage"
+
+# Module-level session so the connection pool survives between invocations
+# (Vercel keeps the process warm) - saves a TCP+TLS handshake per call
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+# EG4 session cookies stay valid for a while, so cache them with a TTL
+# and skip the login POST on warm invocations
+_AUTH_CACHE = {"cookies": None, "expires_at": 0.0}
+_AUTH_TTL = 600  # seconds
+
+# EG4 only updates every few minutes, so a short TTL cache collapses
+# bursts of dashboard polls into a single upstream fetch
+_CACHE = {"body": None, "etag": None, "ts": 0.0}
+_CACHE_TTL = 30.0  # seconds
+
+_UTC = timezone.utc
+
+# Compiled once at import - pulls the digits out of SOC strings like "73 %"
+_SOC_RE = re.compile(r'\d+')
+
+
+class _SocketTuningAdapter(HTTPAdapter):
+    """HTTPAdapter that disables Nagle and enables TCP keep-alive on pooled sockets"""
+
+    _SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self._SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _get_session():
+    """Lazily create a shared session with connection pooling + retries"""
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                s = requests.Session()
+                adapter = _SocketTuningAdapter(
+                    pool_connections=4,
+                    pool_maxsize=8,
+                    max_retries=Retry(
+                        total=2,
+                        backoff_factor=0.2,
+                        status_forcelist=(502, 503, 504),
+                        allowed_methods=frozenset({'GET', 'POST'})
+                    )
+                )
+                s.mount('https://', adapter)
+                # Prefer brotli over gzip for the JSON responses
+                s.headers.update({'Accept-Encoding': 'br, gzip'})
+                _SESSION = s
+    return _SESSION
+
+
+def _login(session, user, password):
+    """Log in to the EG4 portal. Returns an error dict on failure, None on success"""
+    try:
+        login_response = session.post(EG4_LOGIN_URL, data={
+            'account': user,
+            'password': password,
+            'isRem': 'false',
+            'lang': 'en_US'
+        }, headers={'Content-Type': 'application/x-www-form-urlencoded'}, stream=True, timeout=10)
+        # Cookies are set from the headers; drain at most 4KB of body so
+        # a small ack keeps the pooled connection reusable while a full
+        # HTML landing page is cut short
+        with login_response:
+            login_response.raw.read(4096, decode_content=True)
+        if not login_response.ok:
+            return {"error": f"Login failed: HTTP {login_response.status_code}", "battery_soc": 0, "pv_power": 0, "load_power": 0}
+    except Exception as e:
+        return {"error": f"Login failed: {str(e)}", "battery_soc": 0, "pv_power": 0, "load_power": 0}
+    return None
+
+
+def _needs_reauth(resp):
+    """Detect responses that mean the EG4 session cookies have expired"""
+    if resp.status_code == 401:
+        return True
+    # EG4 redirects expired sessions back to the login page
+    if resp.history and '/web/login' in resp.url:
+        return True
+    # Slice bytes before decoding so a big HTML page isn't fully decoded
+    if b'login-form' in resp.content[:2000]:
+        return True
+    return False
+
 
 def get_solar_data():
     """Fetch live data from EG4 API"""
 
-    EG4_LOGIN_URL = "https://monitor.eg4electronics.com/WManage/web/login"
-    EG4_BASE_URL = "https://monitor.eg4electronics.com/WManage"
-
     EG4_USER = os.environ.get('EG4_USER')
     EG4_PASS = os.environ.get('EG4_PASS')
 
     if not EG4_USER or not EG4_PASS:
         return {"error": "Missing credentials", "battery_soc": 0, "pv_power": 0, "load_power": 0}
 
-    # Create session and login
-    session = requests.Session()
+    # Reuse the shared session (keep-alive across warm invocations)
+    session = _get_session()
 
-    try:
-        login_response = session.post(EG4_LOGIN_URL, data={
-            'account': EG4_USER,
-            'password': EG4_PASS,
-            'isRem': 'false',
-            'lang': 'en_US'
-        }, headers={'Content-Type': 'application/x-www-form-urlencoded'}, timeout=10)
-        login_response.raise_for_status()
-    except Exception as e:
-        return {"error": f"Login failed: {str(e)}", "battery_soc": 0, "pv_power": 0, "load_power": 0}
+    # Skip the login POST if we still have fresh cookies from a prior call
+    now = time.time()
+    logged_in = False
+    if _AUTH_CACHE["cookies"] and now < _AUTH_CACHE["expires_at"]:
+        session.cookies.update(_AUTH_CACHE["cookies"])
+        logged_in = True
+
+    if not logged_in:
+        error = _login(session, EG4_USER, EG4_PASS)
+        if error:
+            return error
 
-    # Fetch plant data
+    # Fetch plant data (retry once with a fresh login if the session expired)
     try:
+        # Only the first plant is read, so ask for a single row - the
+        # response shrinks to one plant object instead of the whole account
         api_url = EG4_BASE_URL + "/api/plantOverview/list/viewer"
-        resp = session.post(api_url, data={'page': 1, 'rows': 50}, timeout=10)
+        resp = session.post(api_url, data={'page': 1, 'rows': 1}, timeout=10)
+
+        if _needs_reauth(resp):
+            _AUTH_CACHE["cookies"] = None
+            _AUTH_CACHE["expires_at"] = 0.0
+            error = _login(session, EG4_USER, EG4_PASS)
+            if error:
+                return error
+            resp = session.post(api_url, data={'page': 1, 'rows': 1}, timeout=10)
 
         if resp.status_code == 200:
-            data = resp.json()
+            data = orjson.loads(resp.content)
             rows = data.get('rows', [])
 
             if rows:
                 plant = rows[0]
 
+                # Got data, so the cookies are good - cache them
+                _AUTH_CACHE["cookies"] = session.cookies.get_dict()
+                _AUTH_CACHE["expires_at"] = time.time() + _AUTH_TTL
+
                 # Extract values
                 int_solar = int(plant.get('ppv', 0) or 0)
                 int_load = int(plant.get('pConsumption', 0) or 0)
 
-                # Parse SOC string "73 %" -> 73
-                soc_str = plant.get('soc', '0')
-                try:
-                    int_soc = int(soc_str.replace('%', '').strip())
-                except (ValueError, AttributeError):
-                    int_soc = 0
+                # Parse SOC string "73 %" -> 73 (regex instead of a
+                # replace/strip chain, and no exception-driven fallback)
+                m = _SOC_RE.search(str(plant.get('soc', '0')))
+                int_soc = int(m.group()) if m else 0
+                # Clamp to the 0-100 percentage range without min/max calls
+                int_soc = 0 if int_soc < 0 else 100 if int_soc > 100 else int_soc
 
                 return {
                     "battery_soc": int_soc,
                     "pv_power": int_solar,
                     "load_power": int_load,
-                    "last_updated": datetime.now(timezone.utc).isoformat()
+                    # orjson serializes the datetime itself (OPT_UTC_Z)
+                    "last_updated": datetime.now(_UTC)
                 }
 
     except Exception as e:
@@ -68,14 +183,34 @@ def get_solar_data():
 
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
-        # Get fresh data from EG4
-        data = get_solar_data()
+        # Serve from the TTL cache when fresh, otherwise fetch from EG4
+        if _CACHE["body"] is None or time.time() - _CACHE["ts"] >= _CACHE_TTL:
+            body = orjson.dumps(get_solar_data(), option=orjson.OPT_UTC_Z)
+            etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+            _CACHE["body"] = body
+            _CACHE["etag"] = etag
+            _CACHE["ts"] = time.time()
+        else:
+            # Snapshot both fields once so a concurrent refresh can't
+            # pair a new ETag with an old body
+            body = _CACHE["body"]
+            etag = _CACHE["etag"]
+
+        # Short-circuit with 304 if the client already has this payload
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
 
         # Send response
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')  # Allow SenseCraft to access
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        # no-cache (not no-store) - clients may keep the payload as long
+        # as they revalidate, which is what makes If-None-Match possible
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', etag)
         self.end_headers()
 
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
@@ -1,85 +1,159 @@
 import requests
+from urllib3.util.retry import Retry
+import orjson
+import logging
 import os
+import re
 import sys
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
-# --- Script Version ---
-print("Script Version: 5.1 (Correct field names)")
+# Lazy %-style logging: excerpts below the level are never formatted.
+# Set SOLAR_RELAY_LOG_LEVEL=DEBUG to see raw response excerpts.
+logging.basicConfig(
+    level=os.environ.get('SOLAR_RELAY_LOG_LEVEL', 'INFO'),
+    format='%(asctime)s %(levelname)s %(message)s'
+)
+log = logging.getLogger('solar_relay')
 
 # --- 0. Configuration ---
 EG4_LOGIN_URL = "https://monitor.eg4electronics.com/WManage/web/login"
 EG4_BASE_URL = "https://monitor.eg4electronics.com/WManage"
 
-EG4_USER = os.environ.get('EG4_USER')
-EG4_PASS = os.environ.get('EG4_PASS')
-
-if not EG4_USER or not EG4_PASS:
-    print("ERROR: Missing EG4_USER or EG4_PASS")
-    sys.exit(1)
-
-# --- 1. Login ---
-print("Logging in to EG4 portal...")
-session = requests.Session()
-
-try:
-    login_response = session.post(EG4_LOGIN_URL, data={
-        'account': EG4_USER,
-        'password': EG4_PASS,
-        'isRem': 'false',
-        'lang': 'en_US'
-    }, headers={'Content-Type': 'application/x-www-form-urlencoded'}, timeout=10)
-    login_response.raise_for_status()
-    print("Login successful.")
-except Exception as e:
-    print(f"Login failed: {e}")
-    sys.exit(1)
-
-int_solar = 0
-int_load = 0
-int_soc = 0
-
-# --- 2. Call the discovered API endpoint ---
-print("\n" + "="*50)
-print("Fetching plant overview data...")
-print("="*50)
-
-# The discovered endpoint from the portal JavaScript
-api_url = EG4_BASE_URL + "/api/plantOverview/list/viewer"
-
-# Try both POST (with pagination) and GET
-for method in ["POST", "GET"]:
-    print(f"\n{method} {api_url}")
+# Full endpoint URLs built once at import instead of per call
+# (plantOverview was discovered in the portal JavaScript)
+PLANT_OVERVIEW_URL = EG4_BASE_URL + "/api/plantOverview/list/viewer"
+INVERTER_URL = EG4_BASE_URL + "/web/monitor/inverter"
+
+# Compiled once at import - pulls the numeric part out of values like "73 %".
+# The optional-fraction form can't capture dot-only or multi-dot strings,
+# so the float() below never raises
+_NUM_RE = re.compile(r'(\d+(?:\.\d+)?)')
+
+LOGIN_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+# Hoisted so repeated timestamps skip the module attribute lookup
+_UTC = timezone.utc
+
+def _clamp(x, lo, hi):
+    """Conditional-expression clamp - no builtin min/max call frames"""
+    return lo if x < lo else hi if x > hi else x
+
+
+def _num(x):
+    """Coerce an API value to int without exception-driven control flow.
+
+    Returns None when the value isn't numeric (e.g. "N/A")."""
+    if isinstance(x, (int, float)):
+        return int(x)
+    if isinstance(x, str):
+        m = _NUM_RE.search(x)
+        if m:
+            s = m.group(1)
+            # Skip the float round-trip when the capture is pure digits
+            return int(s) if '.' not in s else int(float(s))
+    return None
+
+
+# Candidate field names per metric on the inverter endpoint, tried in order.
+# Built once at import instead of re-evaluating an or-chain per response.
+_INVERTER_FIELDS = (
+    ('solar', ('solarPower', 'pac', 'ppv')),
+    ('load', ('load', 'loadPower')),
+    ('soc', ('soc', 'batterySoc')),
+)
+
+# EG4 session cookies stay valid for ~30 minutes, so cache them on disk
+# and skip the login POST on back-to-back cron runs
+STATE_DIR = os.environ.get('SOLAR_RELAY_CACHE_DIR', os.path.expanduser('~/.cache/solar_relay'))
+STATE_PATH = os.path.join(STATE_DIR, 'state.json')
+STATE_TTL = 1500  # seconds
+
+
+def load_state():
+    """Read cached cookies from disk; returns None if missing or expired"""
     try:
-        if method == "POST":
-            resp = session.post(api_url, data={'page': 1, 'rows': 50}, timeout=10)
-        else:
-            resp = session.get(api_url, timeout=10)
+        with open(STATE_PATH, 'rb') as f:
+            state = orjson.loads(f.read())
+        if time.time() - state.get('obtained_at', 0) < STATE_TTL and state.get('cookies'):
+            return state
+    except (OSError, orjson.JSONDecodeError):
+        pass
+    return None
 
-        print(f"  Status: {resp.status_code}")
+
+def save_state(cookies):
+    """Persist session cookies atomically so a killed run can't corrupt the cache"""
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = STATE_PATH + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps({'cookies': cookies, 'obtained_at': time.time()}))
+        os.replace(tmp_path, STATE_PATH)
+    except OSError as e:
+        log.warning("Could not save session cache: %s", e)
+
+
+def do_login(session, user, password):
+    """Log in to the EG4 portal. Returns True on success."""
+    log.info("Logging in to EG4 portal...")
+    try:
+        login_response = session.post(EG4_LOGIN_URL, data={
+            'account': user,
+            'password': password,
+            'isRem': 'false',
+            'lang': 'en_US'
+        }, headers=LOGIN_HEADERS, stream=True, timeout=10)
+        # The cookies arrive in the headers - the body is only drained
+        # (bounded) so a small ack still returns the connection to the
+        # pool, while a full HTML landing page gets cut off at 4KB
+        with login_response:
+            login_response.raw.read(4096, decode_content=True)
+        if not login_response.ok:
+            log.error("Login failed: HTTP %s", login_response.status_code)
+            return False
+        log.info("Login successful.")
+        return True
+    except Exception as e:
+        log.error("Login failed: %s", e)
+        return False
+
+
+def try_plant_overview(session):
+    """Fetch solar/load/SOC from the plant overview API. Returns (solar, load, soc) or None."""
+
+    api_url = PLANT_OVERVIEW_URL
+
+    # The endpoint is known to answer POST with pagination - no need to
+    # re-probe GET every run
+    log.info("POST %s", api_url)
+    try:
+        # Only the first plant is used, so one row keeps the payload tiny
+        resp = session.post(api_url, data={'page': 1, 'rows': 1}, stream=True, timeout=10)
+
+        log.info("  Status: %s", resp.status_code)
 
         if resp.status_code == 200:
-            print(f"  Response: {resp.text[:2000]}")
+            # Bounded read: error pages can be full HTML dashboards, and
+            # the JSON we want fits comfortably in 64KB
+            with resp:
+                body = resp.raw.read(65536, decode_content=True)
+            # Gate on the level so the slice + decode never run at INFO
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("  Response: %s", body[:2000].decode('utf-8', 'replace'))
 
             try:
-                data = resp.json()
-                print(f"\n  JSON structure: {list(data.keys()) if isinstance(data, dict) else 'array'}")
-
-                # Check for rows array (common in EasyUI datagrid)
-                rows = []
-                if isinstance(data, dict):
-                    rows = data.get('rows', data.get('data', data.get('list', [])))
-                elif isinstance(data, list):
-                    rows = data
+                data = orjson.loads(body)
+                rows = data.get('rows', []) if isinstance(data, dict) else []
 
                 if rows:
-                    print(f"  Found {len(rows)} plant(s)")
+                    log.info("  Found %d plant(s)", len(rows))
 
-                    # Print full first row for debugging
+                    # Log a bounded excerpt of the first row for debugging;
+                    # %.500r defers the repr until DEBUG is actually on
                     plant = rows[0]
-                    print(f"\n  --- Full plant data ---")
-                    print(json.dumps(plant, indent=2))
-                    print("  --- End plant data ---")
+                    log.debug("  Plant data (first 500 chars): %.500r", plant)
 
                     # Extract values using EG4's actual field names:
                     # - ppv: PV/Solar power in watts
@@ -93,91 +167,201 @@ for method in ["POST", "GET"]:
                     int_load = int(plant.get('pConsumption', 0) or 0)
 
                     # Battery SOC - it's a string like "73 %" so we need to parse it
-                    soc_str = plant.get('soc', '0')
-                    try:
-                        # Remove "%" and any whitespace, then convert to int
-                        int_soc = int(soc_str.replace('%', '').strip())
-                    except (ValueError, AttributeError):
-                        int_soc = 0
+                    int_soc = _num(plant.get('soc', '0')) or 0
 
-                    print(f"\n  Extracted: Solar={int_solar}W, Load={int_load}W, SOC={int_soc}%")
+                    log.info("  Extracted: Solar=%dW, Load=%dW, SOC=%d%%", int_solar, int_load, int_soc)
 
                     if int_solar > 0 or int_soc > 0:
-                        break  # Got data!
+                        return (int_solar, int_load, int_soc)
 
-            except json.JSONDecodeError:
-                print("  Not JSON response")
+            except orjson.JSONDecodeError:
+                log.info("  Not JSON response")
 
     except Exception as e:
-        print(f"  Error: {e}")
-
-# --- 3. If no data yet, try the inverter endpoint ---
-if int_solar == 0 and int_soc == 0:
-    print("\n" + "="*50)
-    print("Trying inverter monitoring endpoint...")
-    print("="*50)
-
-    inverter_url = EG4_BASE_URL + "/web/monitor/inverter"
-
-    for method in ["POST", "GET"]:
-        print(f"\n{method} {inverter_url}")
-        try:
-            if method == "POST":
-                resp = session.post(inverter_url, data={'page': 1, 'rows': 50}, timeout=10)
-            else:
-                resp = session.get(inverter_url, timeout=10)
-
-            print(f"  Status: {resp.status_code}")
-
-            if resp.status_code == 200:
-                content = resp.text[:2000]
-                print(f"  Response: {content}")
-
-                # Try to parse as JSON
-                try:
-                    data = resp.json()
-                    rows = data.get('rows', []) if isinstance(data, dict) else []
-                    if rows:
-                        inverter = rows[0]
-                        print(f"\n  Inverter data: {json.dumps(inverter, indent=2)}")
-
-                        solar = inverter.get('solarPower') or inverter.get('pac') or inverter.get('ppv') or 0
-                        load = inverter.get('load') or inverter.get('loadPower') or 0
-                        soc = inverter.get('soc') or inverter.get('batterySoc') or 0
-
-                        try:
-                            int_solar = int(float(solar)) if solar else 0
-                            int_load = int(float(load)) if load else 0
-                            int_soc = int(float(soc)) if soc else 0
-                        except:
-                            pass
-
-                        if int_solar > 0 or int_soc > 0:
-                            break
-                except:
-                    pass
-
-        except Exception as e:
-            print(f"  Error: {e}")
-
-# --- 4. Final Summary ---
-print("\n" + "="*50)
-print("FINAL RESULTS")
-print("="*50)
-print(f"Solar Power: {int_solar}W")
-print(f"Load Power: {int_load}W")
-print(f"Battery SOC: {int_soc}%")
-
-# --- 5. Write data.json ---
-output_data = {
-    "battery_soc": int_soc,
-    "pv_power": int_solar,
-    "load_power": int_load,
-    "last_updated": datetime.now(timezone.utc).isoformat()
-}
-
-with open('data.json', 'w') as f:
-    json.dump(output_data, f, indent=2)
-
-print(f"\nWrote data.json: {json.dumps(output_data)}")
-print("Done!")
+        log.warning("  Error: %s", e)
+
+    return None
+
+
+def try_inverter(session):
+    """Fetch solar/load/SOC from the inverter monitoring endpoint. Returns (solar, load, soc) or None."""
+
+    inverter_url = INVERTER_URL
+
+    log.info("POST %s", inverter_url)
+    try:
+        resp = session.post(inverter_url, data={'page': 1, 'rows': 50}, stream=True, timeout=10)
+
+        log.info("  Status: %s", resp.status_code)
+
+        if resp.status_code == 200:
+            # Bounded read: error pages can be full HTML dashboards, and
+            # the JSON we want fits comfortably in 64KB
+            with resp:
+                body = resp.raw.read(65536, decode_content=True)
+            # Gate on the level so the slice + decode never run at INFO
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("  Response: %s", body[:2000].decode('utf-8', 'replace'))
+
+            # Try to parse as JSON
+            try:
+                data = orjson.loads(body)
+                rows = data.get('rows', []) if isinstance(data, dict) else []
+                if rows:
+                    inverter = rows[0]
+                    log.debug("  Inverter data: %.500r", inverter)
+
+                    values = {'solar': 0, 'load': 0, 'soc': 0}
+                    for out_key, candidates in _INVERTER_FIELDS:
+                        for field in candidates:
+                            if field in inverter:
+                                n = _num(inverter[field])
+                                # Accept 0 as a real reading (e.g. no sun);
+                                # only fall through on non-numeric values
+                                if n is not None:
+                                    values[out_key] = n
+                                    break
+
+                    int_solar = values['solar']
+                    int_load = values['load']
+                    int_soc = values['soc']
+
+                    if int_solar > 0 or int_soc > 0:
+                        return (int_solar, int_load, int_soc)
+            except:
+                pass
+
+    except Exception as e:
+        log.warning("  Error: %s", e)
+
+    return None
+
+
+def fetch_data(session):
+    """Race both endpoints; the plant overview result wins when both succeed."""
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        overview_future = pool.submit(try_plant_overview, session)
+        inverter_future = pool.submit(try_inverter, session)
+
+        return overview_future.result() or inverter_future.result()
+
+
+def values_unchanged(soc, solar, load):
+    """True when data.json already holds these values and is <5 minutes old.
+
+    Common overnight, when solar sits at 0 for hours - skipping the
+    rewrite keeps the file's mtime (and any downstream sync) quiet."""
+    try:
+        with open('data.json', 'rb') as f:
+            prev = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return False
+    if (prev.get('battery_soc'), prev.get('pv_power'), prev.get('load_power')) != (soc, solar, load):
+        return False
+    try:
+        # OPT_UTC_Z writes a 'Z' suffix, which fromisoformat only accepts
+        # on Python 3.11+ - normalize so 3.9 parses it too
+        prev_ts = datetime.fromisoformat(prev.get('last_updated', '').replace('Z', '+00:00'))
+    except (TypeError, ValueError, AttributeError):
+        return False
+    return (datetime.now(_UTC) - prev_ts).total_seconds() < 300
+
+
+def main():
+    log.info("Script Version: 5.3 (Importable main)")
+
+    eg4_user = os.environ.get('EG4_USER')
+    eg4_pass = os.environ.get('EG4_PASS')
+
+    if not eg4_user or not eg4_pass:
+        log.error("Missing EG4_USER or EG4_PASS")
+        sys.exit(1)
+
+    # --- 1. Login (or reuse cached cookies) ---
+    session = requests.Session()
+    # Pooled adapter so the login + both concurrent probes share keep-alive
+    # connections instead of re-handshaking TLS per call
+    session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        # Retry transient failures on the warm connection instead of losing
+        # the whole cron sample
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'POST'})
+        )
+    ))
+    # Ask for brotli explicitly (requests only advertises it once the
+    # brotli package is installed); JSON compresses ~30% better than gzip.
+    # Pin keep-alive so the login + probes are guaranteed to share connections.
+    session.headers.update({'Accept-Encoding': 'br, gzip', 'Connection': 'keep-alive'})
+
+    state = load_state()
+    used_cached_session = False
+    if state:
+        log.info("Reusing cached EG4 session cookies.")
+        session.cookies.update(state['cookies'])
+        used_cached_session = True
+    elif not do_login(session, eg4_user, eg4_pass):
+        sys.exit(1)
+
+    # --- 2. Race both endpoints concurrently ---
+    # Previously the inverter endpoint was only tried after the plant overview
+    # had fully failed, so the worst case paid both timeout chains in sequence.
+    # Firing both at once caps wall time at the slower of the two; the plant
+    # overview result still wins when both succeed.
+    log.info("Fetching plant overview + inverter data concurrently...")
+
+    int_solar = 0
+    int_load = 0
+    int_soc = 0
+
+    result = fetch_data(session)
+
+    # Cached cookies may have expired server-side - log in fresh and retry once
+    if result is None and used_cached_session:
+        log.info("No data with cached session - logging in fresh...")
+        session.cookies.clear()
+        if do_login(session, eg4_user, eg4_pass):
+            result = fetch_data(session)
+
+    if result:
+        int_solar, int_load, int_soc = result
+        # SOC is a percentage; keep a glitched reading from leaving 0-100
+        int_soc = _clamp(int_soc, 0, 100)
+        save_state(session.cookies.get_dict())
+
+    # --- 3. Final Summary ---
+    log.info("FINAL RESULTS: Solar=%dW Load=%dW SOC=%d%%", int_solar, int_load, int_soc)
+
+    # --- 4. Write data.json ---
+    if values_unchanged(int_soc, int_solar, int_load):
+        log.info("No change in values and data.json is fresh - skipping write.")
+    else:
+        output_data = {
+            "battery_soc": int_soc,
+            "pv_power": int_solar,
+            "load_power": int_load,
+            # orjson serializes the datetime itself (OPT_UTC_Z) - no isoformat churn
+            "last_updated": datetime.now(_UTC)
+        }
+
+        body = orjson.dumps(output_data, option=orjson.OPT_INDENT_2 | orjson.OPT_UTC_Z)
+
+        # Write via tmp + rename so a reader never sees a torn file, even if
+        # the process dies mid-write
+        with open('data.json.tmp', 'wb') as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace('data.json.tmp', 'data.json')
+
+        log.info("Wrote data.json: %s", body.decode())
+
+    log.info("Done!")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,9 @@ Usage:
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import os
 import sys
 
@@ -19,6 +22,15 @@ import sys
 SENSECRAFT_API_URL = "https://sensecraft-hmi-api.seeed.cc/api/v1/user/device/push_data"
 SENSECRAFT_DEVICE_ID = 20222838  # From SenseCraft dashboard URL
 
+# Shared session so repeated pushes reuse one TLS connection
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504))
+))
+session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
 # Get API key from environment
 SENSECRAFT_KEY = os.environ.get('SENSECRAFT_KEY')
 
@@ -47,20 +59,23 @@ payload = {
     }
 }
 
-headers = {
+# Serialize once up front; requests would otherwise json.dumps per call
+payload_body = orjson.dumps(payload)
+
+# Auth + content-type headers are set once on the session, not per call
+session.headers.update({
     "api-key": SENSECRAFT_KEY,
     "Content-Type": "application/json"
-}
+})
 
 print(f"Sending test payload: battery_soc = {test_soc_value}%")
 print(f"Full payload: {payload}")
 print()
 
 try:
-    response = requests.post(
+    response = session.post(
         SENSECRAFT_API_URL,
-        json=payload,
-        headers=headers,
+        data=payload_body,
         timeout=15
     )
 